@@ -1,37 +1,216 @@
+import asyncio
+import hashlib
+import html
+import io
 import logging
 import json
-from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from string import Template
+from typing import Iterator, Optional
 
 import boto3
+import botocore
+import langchain
+import numpy as np
+import openai
+import requests
+import tenacity
 import weaviate
 
+from langchain.cache import InMemoryCache
+from langchain.chains import LLMChain
 from langchain.docstore.document import Document
 from langchain.chains.summarize import load_summarize_chain
+from langchain.chains.summarize.stuff_prompt import PROMPT as SUMMARY_PROMPT
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.llms import OpenAI
 
 
 
 logger = logging.getLogger()
-DATE = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
 ARTICLE_LIMIT = 3
+# Upper bound on OpenAI requests in flight at once
+SUMMARY_CONCURRENCY = 8
+# Articles shorter than this (~3000 tokens) fit in a single prompt, without map_reduce
+STUFF_CHAR_LIMIT = 12000
+# Prompts sent per OpenAI request when summarizing short articles together
+SUMMARY_BATCH_SIZE = 20
+# Attempts per article summary before giving up on a rate limited or failing API
+SUMMARY_ATTEMPTS = 6
+# Longest wait between attempts in seconds, whatever Retry-After asks for
+MAX_RETRY_WAIT = 60
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+)
+
+SUMMARY_CACHE_KEY = "cache/summaries.npz"
+# Minimum cosine similarity for a cached summary to be reused
+SUMMARY_CACHE_THRESHOLD = 0.95
+# Most recent entries kept when the cache is written back to S3
+SUMMARY_CACHE_SIZE = 5000
+# Articles closer than this cosine distance are treated as the same story
+DUPLICATE_DISTANCE = 0.1
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+# Manifests of submitted OpenAI batches waiting for batch_lambda_handler
+BATCH_PREFIX = "batch/pending/"
+# Batches summarize in a single prompt, so long articles are truncated to fit
+BATCH_MAX_CHARS = STUFF_CHAR_LIMIT
+BATCH_FAILED_STATUSES = ["failed", "expired", "cancelled"]
+
+# One empty marker object per published digest, named after its date
+ARTICLE_INDEX_PREFIX = "articles/index/"
+ARTICLE_INDEX_SUFFIX = ".marker"
+# Single-file index the markers replaced, migrated by migrate_legacy_article_index
+LEGACY_ARTICLES_JSON_KEY = "articles.json"
+# Written once articles.json has been backfilled into markers
+LEGACY_MIGRATED_KEY = f"{ARTICLE_INDEX_PREFIX}articles-json.migrated"
 
 topics = ["business", "entertainment", "nation", "science", "technology", "world"]
 
 config = {}
 
-def news_by_topic(topic: str):
-    """Get all articles from Weaviate by topic"""
+# Reused across warm invocations to skip the connection setup
+s3_client = boto3.client("s3")
+# (url, api key) -> weaviate.Client, see get_client
+weaviate_clients = {}
+# Buckets whose articles.json is known to be backfilled into markers
+migrated_buckets = set()
+
+# Created per invocation, inside the event loop started by lambda_handler
+llm_semaphore = None
+# sha256 of article text -> summary task, shared by every topic in an invocation
+summaries_in_flight = {}
+
+# Exact prompt matches are answered in-process across warm invocations
+langchain.llm_cache = InMemoryCache()
+
+# Only articles too long for one prompt are split, into as few chunks as fit
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size = 8000,
+    chunk_overlap  = 200,
+)
+# (api key, model name) -> OpenAI, see get_llm
+summary_llms = {}
+# (api key, model name, chain type) -> chain, see get_chain
+summary_chains = {}
+
+
+class SummaryCache:
+    """Article summaries keyed on the article's Weaviate vector, persisted to S3"""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Drop every cached summary"""
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.summaries = []
+        self.dirty = False
+        # Only a cache that mirrors the stored copy may overwrite it
+        self.loaded = False
+
+    def load(self, s3, bucket_name: str):
+        """Replace the cache contents with the copy stored in S3"""
+        self.clear()
+        try:
+            response = s3.get_object(Bucket=bucket_name, Key=SUMMARY_CACHE_KEY)
+        except s3.exceptions.NoSuchKey:
+            logging.info(f"No summary cache at {SUMMARY_CACHE_KEY}, starting empty")
+            self.loaded = True
+            return
+
+        data = np.load(io.BytesIO(response["Body"].read()))
+        self.vectors = data["vectors"]
+        self.summaries = data["summaries"].tolist()
+        self.loaded = True
+        logging.debug(f"Loaded {len(self.summaries)} cached summaries")
+
+    def save(self, s3, bucket_name: str):
+        """Write the cache back to S3 if it was loaded and gained entries"""
+        if not self.dirty:
+            return
+        if not self.loaded:
+            logging.warning("Summary cache was not loaded, not overwriting the stored copy")
+            return
+
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            vectors=self.vectors[-SUMMARY_CACHE_SIZE:],
+            summaries=np.array(self.summaries[-SUMMARY_CACHE_SIZE:]),
+        )
+        s3.put_object(Bucket=bucket_name, Key=SUMMARY_CACHE_KEY, Body=buffer.getvalue())
+        self.dirty = False
+        logging.debug(f"Saved {len(self.summaries)} cached summaries")
+
+    def get(self, vector: Optional[list]) -> Optional[str]:
+        """Return the summary of the most similar cached article, if close enough"""
+        if vector is None or not self.summaries:
+            return None
+
+        query = _normalize(vector)
+        if query.shape[0] != self.vectors.shape[1]:
+            return None
+
+        similarities = self.vectors @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] < SUMMARY_CACHE_THRESHOLD:
+            return None
+        return self.summaries[best]
+
+    def put(self, vector: Optional[list], summary: str):
+        """Add a summary to the cache, unless it is disabled or failed to load"""
+        if vector is None or not self.loaded:
+            return
+
+        row = _normalize(vector)[np.newaxis, :]
+        if self.summaries and row.shape[1] != self.vectors.shape[1]:
+            # Embedding model changed, older entries can no longer be compared
+            self.clear()
+        self.vectors = np.vstack([self.vectors, row]) if self.summaries else row
+        self.summaries.append(summary)
+        self.dirty = True
+
+
+def article_vector(article: dict) -> Optional[list]:
+    """Weaviate vector of an article, None unless fetched with_vectors"""
+    return (article.get("_additional") or {}).get("vector")
+
+def _normalize(vector: list) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+summary_cache = SummaryCache()
+
+def get_client() -> weaviate.Client:
+    """Weaviate client for the configured cluster, created once and then shared"""
+    key = (config["WEAVIATE_URL"], config["WEAVIATE_API_KEY"])
+
+    if key not in weaviate_clients:
+        weaviate_clients[key] = weaviate.Client(
+            url=config["WEAVIATE_URL"],
+            auth_client_secret=weaviate.AuthApiKey(api_key=config["WEAVIATE_API_KEY"])
+        )
 
-    results = []
+    return weaviate_clients[key]
 
-    offset = 0
+async def news_by_topic(topic: str, date: str, with_vectors: bool = False):
+    """Get all articles from Weaviate by topic published on a date
 
-    client = weaviate.Client(
-        url=config["WEAVIATE_URL"], 
-        auth_client_secret=weaviate.AuthApiKey(api_key=config["WEAVIATE_API_KEY"])
-    )
+    The v3 client only offers a blocking API, so each GraphQL request runs in a
+    worker thread to let the topic queries overlap. When more than one page is
+    needed, the matching articles are counted first and every page is fetched
+    at once. Article vectors are large compared to the text, so they're only
+    fetched when with_vectors is set.
+    """
+
+    client = get_client()
 
     REQ_LIMIT = 100
 
@@ -43,64 +222,257 @@ def news_by_topic(topic: str):
         "operands": [{
             "path": ["published_date"],
             "operator": "Equal",
-            "valueString": DATE
+            "valueString": date
             },{
             "path": ["topic"],
             "operator": "Equal",
             "valueString": topic
+            },{
+            # Articles without text can't be summarized, keep them off the wire
+            "path": ["text"],
+            "operator": "NotEqual",
+            "valueString": ""
         }]
     }
 
-    while True:
-        result = (
+    async def run(query) -> dict:
+        result = await asyncio.to_thread(query.do)
+        if result.get("errors"):
+            raise RuntimeError(f"Weaviate query for {topic} failed: {result['errors']}")
+        return result['data']
+
+    async def fetch_page(offset: int) -> list[dict]:
+        # Never ask for more rows than are still needed to reach ARTICLE_LIMIT
+        limit = min(REQ_LIMIT, ARTICLE_LIMIT - offset)
+        query = (
           client.query
           .get("Article", ["title", "text", "url"])
-          .with_limit(REQ_LIMIT)
+          .with_limit(limit)
           .with_offset(offset)
-          .with_additional(["vector"])
           .with_where(where_filter)
-          .do()
         )
+        if with_vectors:
+            query = query.with_additional(["vector"])
+        result = await run(query)
+
+        return result['Get']['Article']
+
+    if ARTICLE_LIMIT <= REQ_LIMIT:
+        # A single page, counting first would only add a round trip
+        return await fetch_page(0)
+
+    count_query = (
+      client.query
+      .aggregate("Article")
+      .with_where(where_filter)
+      .with_meta_count()
+    )
+    count = await run(count_query)
+    count = count['Aggregate']['Article'][0]['meta']['count']
+
+    offsets = range(0, min(count, ARTICLE_LIMIT), REQ_LIMIT)
+    pages = await asyncio.gather(*(fetch_page(offset) for offset in offsets))
+
+    return [article for page in pages for article in page]
+
+def get_llm() -> OpenAI:
+    """OpenAI LLM for the configured model, shared by every summarize chain"""
+    key = (config["OPENAI_API_KEY"], config["OPENAI_MODEL_NAME"])
+
+    if key not in summary_llms:
+        options = {}
+        if batch_endpoint() == "/v1/completions":
+            # langchain's chat wrapper would forward this to the API as a model kwarg
+            options["batch_size"] = SUMMARY_BATCH_SIZE
+
+        summary_llms[key] = OpenAI(temperature=0, openai_api_key=config["OPENAI_API_KEY"],
+                                   model_name=config["OPENAI_MODEL_NAME"],
+                                   # Retries are left to summarize_article
+                                   max_retries=1,
+                                   **options)
 
-        result = result['data']['Get']['Article']
+    return summary_llms[key]
 
-        results.extend(result)
+def get_chain(chain_type: str):
+    """Summarize chain for the configured model, built once per chain type
+
+    "stuff" is a plain LLMChain over the summarize prompt so several articles
+    can be sent through it at once with aapply.
+    """
+    key = (config["OPENAI_API_KEY"], config["OPENAI_MODEL_NAME"], chain_type)
+
+    if key not in summary_chains:
+        llm = get_llm()
+
+        if chain_type == "stuff":
+            summary_chains[key] = LLMChain(llm=llm, prompt=SUMMARY_PROMPT)
+        else:
+            summary_chains[key] = load_summarize_chain(llm, chain_type=chain_type)
+
+    return summary_chains[key]
+
+
+class PromptBatcher:
+    """Sends short articles submitted in the same event loop iteration as one batch
+
+    The completions endpoint accepts a list of prompts, which langchain packs
+    SUMMARY_BATCH_SIZE to a request, so a batch costs a handful of round trips
+    instead of one per article.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    async def submit(self, article_text: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        if not self.pending:
+            loop.call_soon(lambda: asyncio.ensure_future(self.flush()))
+        self.pending.append((article_text, future))
+
+        return await future
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        chain = get_chain("stuff")
+        logging.debug(f"Summarizing {len(batch)} short articles in one batch")
+
+        async def call(text: str) -> dict:
+            async with llm_semaphore:
+                return await chain.acall({"text": text})
+
+        try:
+            if batch_endpoint() == "/v1/completions":
+                async with llm_semaphore:
+                    outputs = await chain.aapply([{"text": text} for text, _ in batch])
+            else:
+                # langchain's chat wrapper only takes one prompt per request
+                outputs = await asyncio.gather(*(call(text) for text, _ in batch))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
 
-        if len(result) < REQ_LIMIT or len(results) >= ARTICLE_LIMIT:
-            break
+        for (_, future), output in zip(batch, outputs):
+            if not future.done():
+                future.set_result(output[chain.output_key])
 
-        offset += REQ_LIMIT
-    return results
 
-def summarize_article(article_text: str):
+prompt_batcher = PromptBatcher()
+
+def wait_for_retry(retry_state: tenacity.RetryCallState) -> float:
+    """Jittered exponential backoff, but never sooner than the API's Retry-After
+
+    The wait is capped at MAX_RETRY_WAIT.
+    """
+    backoff = tenacity.wait_random_exponential(min=1, max=MAX_RETRY_WAIT)(retry_state)
+    headers = getattr(retry_state.outcome.exception(), "headers", None) or {}
+
+    try:
+        retry_after = float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        retry_after = 0
+
+    # A large Retry-After would otherwise hold the Lambda until it times out
+    return min(max(backoff, retry_after), MAX_RETRY_WAIT)
+
+@tenacity.retry(
+    wait=wait_for_retry,
+    stop=tenacity.stop_after_attempt(SUMMARY_ATTEMPTS),
+    retry=tenacity.retry_if_exception_type(RETRYABLE_ERRORS),
+    before_sleep=tenacity.before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+async def summarize_article(article_text: str):
     """Summarize article using OpenAI API & Langchain"""
 
+    if len(article_text) < STUFF_CHAR_LIMIT:
+        return await prompt_batcher.submit(article_text)
+
     article_doc = Document(page_content=article_text, metadata={"source": str(0)})
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        # Set a really small chunk size, just to show.
-        chunk_size = 1000,
-        chunk_overlap  = 20,
-    )
+    texts = text_splitter.split_documents([article_doc])
 
+    async with llm_semaphore:
+        return await get_chain("map_reduce").arun(texts)
 
-    texts = text_splitter.split_documents([article_doc])
+def group_duplicates(articles: list[dict]) -> list[list[dict]]:
+    """Cluster articles covering the same story by the cosine distance of their vectors
 
-    llm = OpenAI(temperature=0, openai_api_key=config["OPENAI_API_KEY"],
-                 model_name=config["OPENAI_MODEL_NAME"])
-    
-    chain = load_summarize_chain(llm, chain_type="map_reduce")
+    Average-linkage agglomerative clustering: the closest pair of clusters is
+    merged until no pair is within DUPLICATE_DISTANCE. Each cluster is ordered
+    longest text first, so its first member is the one worth summarizing.
+    Without vectors every article is its own cluster.
+    """
+    members = [[i] for i in range(len(articles))]
+    vectors = [article_vector(article) for article in articles]
+
+    if len(articles) > 1 and None not in vectors:
+        vectors = np.vstack([_normalize(vector) for vector in vectors])
+        # Distances between clusters, merged clusters are masked out with inf
+        distances = (1 - vectors @ vectors.T).astype(np.float64)
+        np.fill_diagonal(distances, np.inf)
+
+        while True:
+            a, b = np.unravel_index(np.argmin(distances), distances.shape)
+            if distances[a, b] > DUPLICATE_DISTANCE:
+                break
+
+            # Lance-Williams update: average linkage to the merged cluster is the
+            # size-weighted mean of the linkage to each half
+            size_a, size_b = len(members[a]), len(members[b])
+            merged = (size_a * distances[a] + size_b * distances[b]) / (size_a + size_b)
+            distances[a, :] = merged
+            distances[:, a] = merged
+            distances[a, a] = np.inf
+            distances[b, :] = np.inf
+            distances[:, b] = np.inf
+
+            members[a].extend(members[b])
+            members[b] = []
+
+    clusters = [[articles[i] for i in cluster] for cluster in members if cluster]
+    return [
+        sorted(cluster, key=lambda article: len(article["text"]), reverse=True)
+        for cluster in clusters
+    ]
 
-    return chain.run(texts)
+async def summarize_cached(article_text: str, vector: Optional[list]) -> str:
+    """Summarize article unless a semantically similar one was summarized before"""
+    summary = summary_cache.get(vector)
+    if summary is not None:
+        logging.debug("Using cached summary")
+        return summary
 
-def get_summarized_articles() -> defaultdict:
-    """Get summarized articles from Weaviate by topic"""
-    summarized_articles = defaultdict(dict)
-    
+    summary = await summarize_article(article_text)
+    summary_cache.put(vector, summary)
+    return summary
 
-    for topic in topics:
-        articles = news_by_topic(topic)
+def summarize_once(article_text: str, vector: Optional[list] = None) -> asyncio.Future:
+    """Summarize article, sharing one in-flight request between identical texts"""
+    key = hashlib.sha256(article_text.encode("utf-8")).hexdigest()
+
+    if key in summaries_in_flight:
+        logging.debug(f"Reusing in-flight summary {key[:12]}")
+    else:
+        summaries_in_flight[key] = asyncio.ensure_future(
+            summarize_cached(article_text, vector)
+        )
+
+    return summaries_in_flight[key]
 
+async def get_articles(date: str) -> dict:
+    """Get articles with text from Weaviate by topic, without repeated titles"""
+    summarized_articles = {topic: {} for topic in topics}
+    seen = {topic: set() for topic in topics}
+
+    results = await asyncio.gather(
+        *(news_by_topic(topic, date, config["SEMANTIC_DEDUP"]) for topic in topics)
+    )
+
+    for topic, articles in zip(topics, results):
         logging.debug(topic)
         
         for article in articles:
@@ -109,73 +481,384 @@ def get_summarized_articles() -> defaultdict:
                 logging.debug("Skipping {}, no text".format(article["title"]))
                 continue
                 
-            if article["title"] in summarized_articles[topic]:
+            if article["title"] in seen[topic]:
                 logging.debug("Skipping {}, already in dict".format(article["title"]))
                 continue 
                 
-            article["text"] = summarize_article(article["text"])
+            seen[topic].add(article["title"])
             summarized_articles[topic][article["title"]] = article
 
+    return summarized_articles
+
+def all_articles(summarized_articles: dict) -> list[dict]:
+    """Flatten articles of every topic into a single list"""
+    return [
+        article
+        for articles in summarized_articles.values()
+        for article in articles.values()
+    ]
+
+async def get_summarized_articles(date: str) -> dict:
+    """Get summarized articles from Weaviate by topic"""
+    global llm_semaphore
+    llm_semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    summaries_in_flight.clear()
+    prompt_batcher.pending.clear()
+
+    summarized_articles = await get_articles(date)
+
+    pending = all_articles(summarized_articles)
+    clusters = group_duplicates(pending)
+    logging.debug(f"Summarizing {len(clusters)} stories for {len(pending)} articles")
+
+    summaries = await asyncio.gather(
+        *(
+            summarize_once(cluster[0]["text"], article_vector(cluster[0]))
+            for cluster in clusters
+        )
+    )
+    for cluster, summary in zip(clusters, summaries):
+        for article in cluster:
+            article["text"] = summary
 
     return summarized_articles
 
-def write_summ_article(article: dict, html: str) -> str:
+def openai_request(method: str, path: str, **kwargs) -> requests.Response:
+    """Call the OpenAI REST API directly, for endpoints the pinned SDK lacks"""
+    response = requests.request(
+        method,
+        f"{OPENAI_API_BASE}{path}",
+        headers={"Authorization": f"Bearer {config['OPENAI_API_KEY']}"},
+        timeout=60,
+        **kwargs,
+    )
+    response.raise_for_status()
+    return response
+
+def batch_endpoint() -> str:
+    """OpenAI endpoint serving the configured model, chosen the way langchain does"""
+    model_name = config["OPENAI_MODEL_NAME"]
+    if model_name.startswith("gpt-3.5-turbo") or model_name.startswith("gpt-4"):
+        return "/v1/chat/completions"
+    return "/v1/completions"
+
+def batch_request(custom_id: str, article_text: str) -> dict:
+    """Build one line of an OpenAI batch input file summarizing an article"""
+    prompt = SUMMARY_PROMPT.format(text=article_text[:BATCH_MAX_CHARS])
+    body = {"model": config["OPENAI_MODEL_NAME"], "temperature": 0, "max_tokens": 256}
+
+    if batch_endpoint() == "/v1/chat/completions":
+        body["messages"] = [{"role": "user", "content": prompt}]
+    else:
+        body["prompt"] = prompt
+
+    return {"custom_id": custom_id, "method": "POST", "url": batch_endpoint(), "body": body}
+
+def read_batch_summaries(output: str) -> dict:
+    """Map custom_id to summary for every successful line of a batch output file"""
+    summaries = {}
+
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            logging.warning(f"Batch request {result['custom_id']} failed: {result.get('error') or response.get('body')}")
+            continue
+
+        choice = response["body"]["choices"][0]
+        text = choice["message"]["content"] if "message" in choice else choice["text"]
+        summaries[result["custom_id"]] = text.strip()
+
+    return summaries
+
+def submit_summary_batch(s3, bucket_name: str, date: str):
+    """Queue article summaries on the OpenAI Batch API
+
+    Articles are fetched and deduplicated as in the synchronous path, then
+    every uncached story becomes one line of a batch input file. The articles
+    are parked in a manifest under BATCH_PREFIX until batch_lambda_handler
+    finds the batch completed and publishes the digest.
+    """
+    summarized_articles = asyncio.run(get_articles(date))
+
+    batch_requests = {}
+    vectors = {}
+    for cluster in group_duplicates(all_articles(summarized_articles)):
+        representative = cluster[0]
+        vector = article_vector(representative)
+        summary = summary_cache.get(vector)
+
+        if summary is None:
+            custom_id = hashlib.sha256(representative["text"].encode("utf-8")).hexdigest()
+            batch_requests[custom_id] = batch_request(custom_id, representative["text"])
+            vectors[custom_id] = vector
+
+        for article in cluster:
+            if summary is None:
+                article["summary_id"] = custom_id
+            else:
+                article["text"] = summary
+
+    for article in all_articles(summarized_articles):
+        article.pop("_additional", None)
+
+    if not batch_requests:
+        logging.info("Every summary is cached, publishing without a batch")
+        write_digest(s3, bucket_name, summarized_articles, date)
+        update_article_index(s3, bucket_name, date)
+        return
+
+    input_file = openai_request(
+        "POST",
+        "/files",
+        data={"purpose": "batch"},
+        files={
+            "file": (
+                f"{date}.jsonl",
+                "\n".join(json.dumps(request) for request in batch_requests.values()),
+            )
+        },
+    ).json()
+    batch = openai_request(
+        "POST",
+        "/batches",
+        json={
+            "input_file_id": input_file["id"],
+            "endpoint": batch_endpoint(),
+            "completion_window": "24h",
+        },
+    ).json()
+
+    manifest = {
+        "batch_id": batch["id"],
+        "date": date,
+        "articles": summarized_articles,
+        "vectors": vectors,
+    }
+    s3.put_object(
+        Bucket=bucket_name, Key=f"{BATCH_PREFIX}{batch['id']}.json", Body=json.dumps(manifest)
+    )
+    logging.info(f"Submitted batch {batch['id']} with {len(batch_requests)} summaries")
+
+async def summarize_missing(texts: dict, vectors: dict) -> dict:
+    """Summarize directly the requests a finished batch returned no summary for"""
+    global llm_semaphore
+    llm_semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    summaries_in_flight.clear()
+    prompt_batcher.pending.clear()
+
+    custom_ids = list(texts)
+    summaries = await asyncio.gather(
+        *(summarize_once(texts[custom_id], vectors.get(custom_id)) for custom_id in custom_ids)
+    )
+    return dict(zip(custom_ids, summaries))
+
+def collect_summary_batch(s3, bucket_name: str, manifest_key: str):
+    """Publish the digest of a submitted batch once OpenAI has finished it
+
+    Expired batches still have an output file for the requests they got to,
+    and failed or cancelled ones may have none. Whatever the batch did not
+    summarize is summarized directly, so the digest is always complete. If
+    that fails too, the manifest is kept and the next run tries again.
+    """
+    response = s3.get_object(Bucket=bucket_name, Key=manifest_key)
+    manifest = json.loads(response["Body"].read().decode("utf-8"))
+
+    batch = openai_request("GET", f"/batches/{manifest['batch_id']}").json()
+    if batch["status"] in BATCH_FAILED_STATUSES:
+        logging.warning(f"Batch {batch['id']} for {manifest['date']} {batch['status']}, summarizing the rest directly")
+    elif batch["status"] != "completed":
+        logging.info(f"Batch {batch['id']} for {manifest['date']} is {batch['status']}")
+        return
+
+    summaries = {}
+    if batch.get("output_file_id"):
+        output = openai_request("GET", f"/files/{batch['output_file_id']}/content").text
+        summaries = read_batch_summaries(output)
+
+    for custom_id, summary in summaries.items():
+        summary_cache.put(manifest["vectors"].get(custom_id), summary)
+
+    # Articles waiting on a summary still carry their full text
+    missing = {}
+    for articles in manifest["articles"].values():
+        for article in articles.values():
+            summary_id = article.get("summary_id")
+            if summary_id is not None and summary_id not in summaries:
+                missing[summary_id] = article["text"]
+
+    if missing:
+        logging.info(f"Summarizing {len(missing)} articles batch {batch['id']} left out")
+        summaries.update(asyncio.run(summarize_missing(missing, manifest["vectors"])))
+
+    summarized_articles = {topic: {} for topic in topics}
+    for topic, articles in manifest["articles"].items():
+        for title, article in articles.items():
+            summary_id = article.pop("summary_id", None)
+            if summary_id is not None:
+                article["text"] = summaries[summary_id]
+            summarized_articles.setdefault(topic, {})[title] = article
+
+    write_digest(s3, bucket_name, summarized_articles, manifest["date"])
+    update_article_index(s3, bucket_name, manifest["date"])
+    s3.delete_object(Bucket=bucket_name, Key=manifest_key)
+
+# Parsed once at import, every field is HTML-escaped before substitution
+ARTICLE_TEMPLATE = Template("""<h3>$title</h3>
+<p>$text</p>
+<a href="$url"> source </a>
+""")
+
+def write_summ_article(article: dict) -> str:
     """Write summarized article to HTML"""
     logging.debug("Starting: write_summ_article for {}".format(article["title"]))
-    article_html = f"""<h3>{article["title"].replace('.json', '')}</h3>
-<p>{article["text"]}</p>
-<a href=\"{article["url"]}\"> source </a>
-"""
-    
-    html += article_html
+    article_html = ARTICLE_TEMPLATE.substitute(
+        title=html.escape(article["title"].replace('.json', '')),
+        text=html.escape(article["text"]),
+        url=html.escape(article["url"]),
+    )
+
     logging.debug("Finished: write_summ_article for {}".format(article["title"]))
-    return html 
-    
-def write_section(articles: list[dict], topic: str):
-    """Write topic section to HTML"""
+    return article_html
 
-    logging.debug(f"Starting: write_section for {topic} with {len(articles)} articles")
+def iter_section(articles: dict, topic: str) -> Iterator[str]:
+    """Yield topic section HTML, one article at a time"""
 
-    html=f"""<h1>{topic.capitalize()}</h1>\n<hr>\n"""
-    
-    for article in articles.values():
-        html = write_summ_article(article, html)
-    html += "\n"
+    logging.debug(f"Starting: iter_section for {topic} with {len(articles)} articles")
 
-    logging.debug(f"Finished: write_section for {topic}")
-    return html
+    yield f"""<h1>{topic.capitalize()}</h1>\n<hr>\n"""
+    for article in articles.values():
+        yield write_summ_article(article)
+    yield "\n"
 
-def write_html():
-    logging.debug("Staring: write_html")
-    """Write HTML file"""
+    logging.debug(f"Finished: iter_section for {topic}")
 
-    summarized_articles = get_summarized_articles()
+def iter_html(summarized_articles: dict, date: str) -> Iterator[str]:
+    """Yield the HTML file in fragments, so it never has to be held whole"""
+    logging.debug("Staring: iter_html")
 
-    article_html = f"""<!DOCTYPE html>
+    yield f"""<!DOCTYPE html>
     <html lang="en-US">
     <head>
         <meta charset="UTF-8">
         <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1">
-        <title>NeuralDigest Summary: {DATE}</title>
+        <title>NeuralDigest Summary: {date}</title>
         <link href="https://fonts.googleapis.com/css2?family=Roboto:wght@400;700&display=swap" rel="stylesheet">
         <link href="../style.css" rel="stylesheet">
     </head>
-    <h1> Summary for News Articles: {DATE} </h1>
+    <h1> Summary for News Articles: {date} </h1>
     <hr>
     <body>
     """
 
     for topic in topics:
-        article_html += write_section(summarized_articles[topic], topic)
+        yield from iter_section(summarized_articles.get(topic, {}), topic)
 
-    article_html += "</html>"
-    
-    logging.debug("Finished: write_html")
-    return article_html
+    yield "</html>"
 
+    logging.debug("Finished: iter_html")
 
-def lambda_handler(event, _):
+
+class FragmentStream(io.RawIOBase):
+    """Read-only binary file object over an iterator of text fragments"""
+
+    def __init__(self, fragments: Iterator[str]):
+        self._fragments = fragments
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            try:
+                self._pending = next(self._fragments).encode("utf-8")
+            except StopIteration:
+                return 0
+
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+
+def write_digest(s3, bucket_name: str, summarized_articles: dict, date: str):
+    """Write the digest HTML for a date to S3, raising if the upload fails"""
+    file_name = f'articles/{date}.html'
+
+    # Write article_html to S3 bucket
+    s3.upload_fileobj(
+        FragmentStream(iter_html(summarized_articles, date)),
+        bucket_name,
+        file_name,
+        ExtraArgs={'ContentType': 'text/html'},
+    )
+    logging.info(f'Successfully written {file_name} to {bucket_name}')
+
+def update_article_index(s3, bucket_name: str, date: str):
+    """Mark the digest for a date as published
+
+    Writing a marker costs the same however many digests exist, unlike
+    rewriting a single index; readers list the markers with list_article_dates.
+    """
+    marker_key = f"{ARTICLE_INDEX_PREFIX}{date}{ARTICLE_INDEX_SUFFIX}"
+    s3.put_object(Bucket=bucket_name, Key=marker_key, Body=b"")
+    logging.debug(f"Written {marker_key} to {bucket_name}")
+
+def list_article_dates(s3, bucket_name: str) -> list[str]:
+    """Dates of every published digest, newest first"""
+    dates = []
+
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=ARTICLE_INDEX_PREFIX):
+        for marker in page.get("Contents", []):
+            name = marker["Key"][len(ARTICLE_INDEX_PREFIX):]
+            if name.endswith(ARTICLE_INDEX_SUFFIX):
+                dates.append(name[:-len(ARTICLE_INDEX_SUFFIX)])
+
+    return sorted(dates, reverse=True)
+
+def migrate_legacy_article_index(s3, bucket_name: str):
+    """Write markers for every date in the legacy articles.json, once per bucket
+
+    articles.json is left in place, frozen, for readers that haven't moved to
+    list_article_dates yet. The LEGACY_MIGRATED_KEY sentinel is written last,
+    so an interrupted backfill is repeated, and a finished one costs later
+    cold starts a HEAD request instead of fetching the file.
+    """
+    if bucket_name in migrated_buckets:
+        return
+
+    try:
+        s3.head_object(Bucket=bucket_name, Key=LEGACY_MIGRATED_KEY)
+        migrated_buckets.add(bucket_name)
+        return
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ["404", "NoSuchKey", "NotFound"]:
+            raise
+
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=LEGACY_ARTICLES_JSON_KEY)
+        legacy_dates = json.loads(response['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        legacy_dates = []
+
+    published = set(list_article_dates(s3, bucket_name))
+    for date in legacy_dates:
+        if date not in published:
+            update_article_index(s3, bucket_name, date)
+
+    s3.put_object(Bucket=bucket_name, Key=LEGACY_MIGRATED_KEY, Body=b"")
+    migrated_buckets.add(bucket_name)
+    logging.info(f"Migrated {len(legacy_dates)} dates from {LEGACY_ARTICLES_JSON_KEY}")
+
+def configure(event: dict):
+    """Set log level and config from the invocation event"""
     if "LOG_LEVEL" in event and event["LOG_LEVEL"].lower() in [
         "debug",
         "info",
@@ -187,13 +870,6 @@ def lambda_handler(event, _):
     else:
         logger.setLevel(level=logging.INFO)
 
-    logging.debug("Initiating lambda_handler")
-    s3 = boto3.client('s3')
-    file_name = f'articles/{DATE}.html'
-    
-    bucket_name = event["S3_BUCKET_NAME"]
-
-    
     configVars = [
         "WEAVIATE_URL",
         "WEAVIATE_API_KEY",
@@ -205,23 +881,78 @@ def lambda_handler(event, _):
             config[conf] = event[conf]
         except KeyError:
             logging.warning(f"Missing event variable: {conf}")
+
+    # Fetch article vectors for duplicate detection and the summary cache
+    config["SEMANTIC_DEDUP"] = str(event.get("SEMANTIC_DEDUP", False)).lower() == "true"
+
+def load_summary_cache(s3, bucket_name: str):
+    """Load the summary cache, falling back to an empty one"""
+    if not config["SEMANTIC_DEDUP"]:
+        summary_cache.clear()
+        return
+
+    try:
+        summary_cache.load(s3, bucket_name)
+    except Exception as e:
+        logging.warning(f'Error loading summary cache, starting empty and not saving it: {str(e)}')
+        summary_cache.clear()
+
+def save_summary_cache(s3, bucket_name: str):
+    """Persist the summary cache, logging rather than failing the run"""
     try:
-        # Write article_html to S3 bucket
-        s3.put_object(Body=write_html(), Bucket=bucket_name, Key=file_name, ContentType='text/html')
-        logging.info(f'Successfully written {file_name} to {bucket_name}')
+        summary_cache.save(s3, bucket_name)
     except Exception as e:
-        logging.warning(f'Error writing {file_name} to {bucket_name}: {str(e)}')
-    
-    logging.debug("Retrieving and modifying articles.json")
-    articles_json_key = "articles.json"
-    response = s3.get_object(Bucket=bucket_name, Key=articles_json_key)
-    content = response['Body'].read().decode('utf-8')
-    articles = json.loads(content)
+        logging.warning(f'Error saving summary cache: {str(e)}')
 
-    if DATE not in articles:
-        articles.insert(0, DATE)
 
-    modified_content = json.dumps(articles)
+def lambda_handler(event, _):
+    configure(event)
+
+    logging.debug("Initiating lambda_handler")
+    s3 = s3_client
+    bucket_name = event["S3_BUCKET_NAME"]
+    # Computed per invocation, a warm Lambda can outlive the day it started on
+    date = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    load_summary_cache(s3, bucket_name)
+
+    try:
+        migrate_legacy_article_index(s3, bucket_name)
+    except Exception as e:
+        logging.warning(f'Error migrating {LEGACY_ARTICLES_JSON_KEY}: {str(e)}')
+
+    if event.get("SUMMARY_MODE", "").lower() == "batch":
+        try:
+            submit_summary_batch(s3, bucket_name, date)
+        except Exception as e:
+            logging.warning(f'Error submitting summary batch for {date}: {str(e)}')
+    else:
+        try:
+            summarized_articles = asyncio.run(get_summarized_articles(date))
+            write_digest(s3, bucket_name, summarized_articles, date)
+            update_article_index(s3, bucket_name, date)
+        except Exception as e:
+            logging.warning(f'Error publishing articles for {date}: {str(e)}')
+
+    save_summary_cache(s3, bucket_name)
+
+
+def batch_lambda_handler(event, _):
+    """Publish digests whose OpenAI batch has completed, meant to run on a schedule"""
+    configure(event)
+
+    logging.debug("Initiating batch_lambda_handler")
+    s3 = s3_client
+    bucket_name = event["S3_BUCKET_NAME"]
+
+    load_summary_cache(s3, bucket_name)
 
-    s3.put_object(Bucket=bucket_name, Key=articles_json_key, Body=modified_content)
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=BATCH_PREFIX):
+        for manifest in page.get("Contents", []):
+            try:
+                collect_summary_batch(s3, bucket_name, manifest["Key"])
+            except Exception as e:
+                logging.warning(f'Error collecting batch {manifest["Key"]}: {str(e)}')
 
+    save_summary_cache(s3, bucket_name)
@@ -0,0 +1,465 @@
+import asyncio
+import io
+import json
+import os
+
+import botocore
+import numpy as np
+import pytest
+import tenacity
+
+# app creates its S3 client at import
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import app  # noqa: E402
+
+
+class FakeS3:
+    """In-memory stand-in for the S3 calls app makes"""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.gets = []
+
+    def get_object(self, Bucket, Key):
+        self.gets.append(Key)
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+            )
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self.objects[(Bucket, Key)] = Fileobj.read()
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def get_paginator(self, operation):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(
+                    key
+                    for bucket, key in s3.objects
+                    if bucket == Bucket and key.startswith(Prefix)
+                )
+                yield {"Contents": [{"Key": key} for key in keys]}
+
+        return Paginator()
+
+
+def batch_line(custom_id, status_code=200, body=None, error=None):
+    return json.dumps(
+        {
+            "id": f"batch_req_{custom_id}",
+            "custom_id": custom_id,
+            "response": {"status_code": status_code, "body": body},
+            "error": error,
+        }
+    )
+
+
+def test_read_batch_summaries():
+    output = "\n".join(
+        [
+            batch_line("completion", body={"choices": [{"text": "\n A summary. "}]}),
+            batch_line(
+                "chat",
+                body={"choices": [{"message": {"role": "assistant", "content": "Chat."}}]},
+            ),
+            "",
+            batch_line("rate_limited", status_code=429, body={"error": {"message": "slow"}}),
+            json.dumps(
+                {
+                    "custom_id": "failed",
+                    "response": None,
+                    "error": {"code": "server_error", "message": "boom"},
+                }
+            ),
+        ]
+    )
+
+    assert app.read_batch_summaries(output) == {
+        "completion": "A summary.",
+        "chat": "Chat.",
+    }
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    @property
+    def text(self):
+        return self.body
+
+
+def pending_batch(s3, status, output=None):
+    """Store a manifest for a batch with two articles awaiting summaries"""
+    manifest = {
+        "batch_id": "batch_1",
+        "date": "2023-05-01",
+        "articles": {
+            "science": {
+                title: {"title": title, "url": f"https://example.com/{title}", **fields}
+                for title, fields in [
+                    ("Returned", {"text": "Returned text", "summary_id": "returned"}),
+                    ("Dropped", {"text": "Dropped text", "summary_id": "dropped"}),
+                    ("Cached", {"text": "Cached summary"}),
+                ]
+            }
+        },
+        "vectors": {},
+    }
+    s3.put_object(Bucket="bucket", Key=f"{app.BATCH_PREFIX}batch_1.json", Body=json.dumps(manifest).encode())
+
+    def openai_request(method, path, **kwargs):
+        if path == "/batches/batch_1":
+            batch = {"id": "batch_1", "status": status}
+            if output is not None:
+                batch["output_file_id"] = "file_1"
+            return FakeResponse(batch)
+        assert path == "/files/file_1/content"
+        return FakeResponse(output)
+
+    return openai_request
+
+
+def test_collect_expired_batch_summarizes_the_rest(monkeypatch):
+    s3 = FakeS3()
+    output = batch_line("returned", body={"choices": [{"text": "From the batch"}]})
+    monkeypatch.setattr(app, "openai_request", pending_batch(s3, "expired", output))
+    monkeypatch.setattr(app, "summary_cache", app.SummaryCache())
+    summarized = []
+
+    async def summarize_article(article_text):
+        summarized.append(article_text)
+        return "Summarized directly"
+
+    monkeypatch.setattr(app, "summarize_article", summarize_article)
+    app.collect_summary_batch(s3, "bucket", f"{app.BATCH_PREFIX}batch_1.json")
+
+    assert summarized == ["Dropped text"]
+    html = s3.objects[("bucket", "articles/2023-05-01.html")].decode()
+    for text in ["From the batch", "Summarized directly", "Cached summary"]:
+        assert text in html
+    assert ("bucket", f"{app.ARTICLE_INDEX_PREFIX}2023-05-01{app.ARTICLE_INDEX_SUFFIX}") in s3.objects
+    assert ("bucket", f"{app.BATCH_PREFIX}batch_1.json") not in s3.objects
+
+
+def test_collect_failed_batch_keeps_manifest_when_fallback_fails(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(app, "openai_request", pending_batch(s3, "failed"))
+    monkeypatch.setattr(app, "summary_cache", app.SummaryCache())
+
+    async def summarize_article(article_text):
+        raise RuntimeError("OpenAI is down")
+
+    monkeypatch.setattr(app, "summarize_article", summarize_article)
+    with pytest.raises(RuntimeError):
+        app.collect_summary_batch(s3, "bucket", f"{app.BATCH_PREFIX}batch_1.json")
+
+    assert ("bucket", "articles/2023-05-01.html") not in s3.objects
+    assert ("bucket", f"{app.BATCH_PREFIX}batch_1.json") in s3.objects
+
+
+def vector_article(title, text, vector):
+    return {"title": title, "text": text, "_additional": {"vector": vector}}
+
+
+def titles(clusters):
+    return [[article["title"] for article in cluster] for cluster in clusters]
+
+
+def test_group_duplicates_merges_same_story():
+    articles = [
+        vector_article("Short", "Rates rise", [1.0, 0.0, 0.0]),
+        vector_article("Other", "Launch delayed", [0.0, 1.0, 0.0]),
+        vector_article("Long", "Central bank raises rates", [0.99, 0.05, 0.0]),
+        vector_article("Third", "Storm makes landfall", [0.0, 0.0, 1.0]),
+    ]
+
+    clusters = app.group_duplicates(articles)
+
+    assert sorted(titles(clusters)) == [["Long", "Short"], ["Other"], ["Third"]]
+
+
+def test_group_duplicates_merges_by_average_linkage():
+    # Each neighbour is within DUPLICATE_DISTANCE of the next, but the ends are not
+    angle = np.arccos(1 - app.DUPLICATE_DISTANCE) * 0.9
+    articles = [
+        vector_article(str(i), "x" * i, [np.cos(i * angle), np.sin(i * angle)])
+        for i in range(1, 5)
+    ]
+
+    clusters = app.group_duplicates(articles)
+
+    assert sorted(titles(clusters)) == [["2", "1"], ["4", "3"]]
+
+
+def test_group_duplicates_without_vectors():
+    articles = [
+        vector_article("One", "Same text", [1.0, 0.0]),
+        {"title": "Two", "text": "Same text"},
+    ]
+
+    assert titles(app.group_duplicates(articles)) == [["One"], ["Two"]]
+    assert app.group_duplicates([]) == []
+
+
+class FakeChain:
+    """Stand-in for the summarize chains, recording how it was called"""
+
+    output_key = "text"
+
+    def __init__(self, error=None):
+        self.error = error
+        self.batches = []
+        self.runs = []
+        self.running = 0
+        self.most_running = 0
+
+    async def aapply(self, inputs):
+        self.batches.append([item["text"] for item in inputs])
+        if self.error:
+            raise self.error
+        return [{"text": f"Summary of {item['text']}"} for item in inputs]
+
+    async def acall(self, inputs):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        await asyncio.sleep(0)
+        self.running -= 1
+        return {"text": f"Summary of {inputs['text']}"}
+
+    async def arun(self, documents):
+        self.runs.append(documents)
+        return "Summary of a long article"
+
+
+@pytest.fixture
+def fake_chain(monkeypatch):
+    chain = FakeChain()
+    monkeypatch.setattr(app, "get_chain", lambda chain_type: chain)
+    monkeypatch.setattr(app, "prompt_batcher", app.PromptBatcher())
+    monkeypatch.setitem(app.config, "OPENAI_MODEL_NAME", "text-davinci-003")
+    return chain
+
+
+async def summarize_all(texts, concurrency=app.SUMMARY_CONCURRENCY):
+    app.llm_semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(app.summarize_article(text) for text in texts))
+
+
+def test_prompt_batcher_sends_one_batch(fake_chain):
+    texts = [f"Article {i}" for i in range(25)]
+
+    summaries = asyncio.run(summarize_all(texts))
+
+    assert fake_chain.batches == [texts]
+    assert summaries == [f"Summary of {text}" for text in texts]
+
+
+def test_long_article_is_split_not_batched(fake_chain):
+    long_text = "word " * app.STUFF_CHAR_LIMIT
+
+    summaries = asyncio.run(summarize_all(["Short article", long_text]))
+
+    assert summaries == ["Summary of Short article", "Summary of a long article"]
+    assert fake_chain.batches == [["Short article"]]
+    assert len(fake_chain.runs) == 1 and len(fake_chain.runs[0]) > 1
+
+
+def test_prompt_batcher_chat_model_takes_a_slot_per_call(fake_chain, monkeypatch):
+    monkeypatch.setitem(app.config, "OPENAI_MODEL_NAME", "gpt-3.5-turbo")
+    texts = [f"Article {i}" for i in range(6)]
+
+    summaries = asyncio.run(summarize_all(texts, concurrency=2))
+
+    assert fake_chain.batches == []
+    assert fake_chain.most_running == 2
+    assert summaries == [f"Summary of {text}" for text in texts]
+
+
+def test_prompt_batcher_error_reaches_every_article(fake_chain):
+    fake_chain.error = ValueError("Bad request")
+
+    async def summarize():
+        app.llm_semaphore = asyncio.Semaphore(app.SUMMARY_CONCURRENCY)
+        return await asyncio.gather(
+            *(app.summarize_article(f"Article {i}") for i in range(3)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(summarize())
+
+    assert len(fake_chain.batches) == 1
+    assert all(result is fake_chain.error for result in results)
+
+
+class RateLimited(Exception):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+@pytest.mark.parametrize(
+    "headers, shortest, longest",
+    [
+        ({"retry-after": "30"}, 30, 30),
+        ({"retry-after": "86400"}, app.MAX_RETRY_WAIT, app.MAX_RETRY_WAIT),
+        ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0, 2),
+        ({}, 0, 2),
+        (None, 0, 2),
+    ],
+)
+def test_wait_for_retry(headers, shortest, longest):
+    retry_state = tenacity.RetryCallState(None, None, (), {})
+    retry_state.attempt_number = 1
+    retry_state.set_exception((RateLimited, RateLimited(headers), None))
+
+    assert shortest <= app.wait_for_retry(retry_state) <= longest
+
+
+def test_summary_cache_round_trip():
+    s3 = FakeS3()
+    cache = app.SummaryCache()
+    cache.load(s3, "bucket")
+    cache.put([1.0, 0.0, 0.0], "About x")
+    cache.put([0.0, 1.0, 0.0], "Über y")
+    cache.put(None, "Without a vector")
+    cache.save(s3, "bucket")
+
+    loaded = app.SummaryCache()
+    loaded.load(s3, "bucket")
+
+    assert loaded.summaries == ["About x", "Über y"]
+    assert loaded.get([0.0, 2.0, 0.01]) == "Über y"
+    assert loaded.get([1.0, 1.0, 0.0]) is None
+    assert loaded.get([1.0, 0.0]) is None
+    assert not loaded.dirty
+
+
+def test_summary_cache_load_missing():
+    cache = app.SummaryCache()
+    cache.put([1.0, 0.0], "Stale")
+
+    cache.load(FakeS3(), "bucket")
+
+    assert cache.summaries == []
+    assert cache.get([1.0, 0.0]) is None
+
+
+def test_summary_cache_save_keeps_most_recent(monkeypatch):
+    monkeypatch.setattr(app, "SUMMARY_CACHE_SIZE", 2)
+    s3 = FakeS3()
+    cache = app.SummaryCache()
+    cache.load(s3, "bucket")
+    for i in range(3):
+        cache.put(np.eye(3)[i].tolist(), f"Summary {i}")
+    cache.save(s3, "bucket")
+
+    cache.load(s3, "bucket")
+
+    assert cache.summaries == ["Summary 1", "Summary 2"]
+    assert cache.vectors.shape == (2, 3)
+
+
+def test_summary_cache_not_saved_after_failed_load():
+    s3 = FakeS3()
+    s3.put_object("bucket", app.SUMMARY_CACHE_KEY, b"not an npz")
+    cache = app.SummaryCache()
+
+    with pytest.raises(Exception):
+        cache.load(s3, "bucket")
+    cache.put([1.0, 0.0], "New")
+    cache.save(s3, "bucket")
+
+    assert s3.objects[("bucket", app.SUMMARY_CACHE_KEY)] == b"not an npz"
+
+
+def test_summary_cache_untouched_without_semantic_dedup(monkeypatch):
+    s3 = FakeS3()
+    stored = app.SummaryCache()
+    stored.load(s3, "bucket")
+    for i in range(3):
+        stored.put(np.eye(3)[i].tolist(), f"Summary {i}")
+    stored.save(s3, "bucket")
+    before = s3.objects[("bucket", app.SUMMARY_CACHE_KEY)]
+
+    monkeypatch.setattr(app, "summary_cache", app.SummaryCache())
+    monkeypatch.setitem(app.config, "SEMANTIC_DEDUP", False)
+    app.load_summary_cache(s3, "bucket")
+    # As collect_summary_batch does with vectors stored in a manifest
+    app.summary_cache.put([1.0, 1.0, 0.0], "From a batch")
+    app.save_summary_cache(s3, "bucket")
+
+    assert s3.objects[("bucket", app.SUMMARY_CACHE_KEY)] == before
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 1024])
+def test_fragment_stream_read(size):
+    fragments = ["<p>", "é", "", "日本語", "😀 end</p>"]
+    stream = app.FragmentStream(iter(fragments))
+
+    chunks = []
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        assert len(chunk) <= size
+        chunks.append(chunk)
+
+    assert b"".join(chunks).decode("utf-8") == "".join(fragments)
+
+
+def test_fragment_stream_read_all():
+    stream = app.FragmentStream(iter(["a", "ß", "c"]))
+
+    assert stream.read() == "aßc".encode("utf-8")
+
+
+def test_migrate_legacy_article_index(monkeypatch):
+    monkeypatch.setattr(app, "migrated_buckets", set())
+    s3 = FakeS3()
+    legacy = json.dumps(["2023-05-02", "2023-05-01"]).encode("utf-8")
+    s3.put_object("bucket", "articles.json", legacy)
+    app.update_article_index(s3, "bucket", "2023-05-02")
+
+    app.migrate_legacy_article_index(s3, "bucket")
+
+    assert app.list_article_dates(s3, "bucket") == ["2023-05-02", "2023-05-01"]
+    assert s3.objects[("bucket", "articles.json")] == legacy
+
+    # Neither a warm nor a cold start fetches articles.json again
+    s3.gets.clear()
+    app.migrate_legacy_article_index(s3, "bucket")
+    app.migrated_buckets.clear()
+    app.migrate_legacy_article_index(s3, "bucket")
+    assert s3.gets == []
+
+
+def test_migrate_without_legacy_index(monkeypatch):
+    monkeypatch.setattr(app, "migrated_buckets", set())
+    s3 = FakeS3()
+
+    app.migrate_legacy_article_index(s3, "bucket")
+
+    assert app.list_article_dates(s3, "bucket") == []
+    assert ("bucket", app.LEGACY_MIGRATED_KEY) in s3.objects